@@ -34,13 +34,13 @@ def show_config(runner):
             sys.stdout.write('%s=%s\n' % (key, value))
     else:
         # Specific keys requested.
-        for filter in runner.opts.arg:
+        for prefix in runner.opts.arg:
             n = 0
-            for (key, value) in runner.config.query_pairs(filter = filter):
+            for (key, value) in runner.config.query_pairs(prefix = prefix):
                 sys.stdout.write('%s=%s\n' % (key, value))
                 n += 1
             if n == 0:
-                sys.stdout.write('%s *not found*\n' % filter)
+                sys.stdout.write('%s *not found*\n' % prefix)
 
 @VOLT.Multi_Command(
     description  = 'Display various types of information.',
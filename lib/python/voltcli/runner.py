@@ -141,6 +141,9 @@ class JavaRunner(object):
         for arg in args:
             if arg is not None:
                 java_args.append(arg)
+        # Save configuration changes now, because exit handlers don't run
+        # when the process is replaced or daemonized.
+        self.config.flush()
         daemonizer = utility.kwargs_get(kwargs, 'daemonizer')
         if daemonizer:
             # Run as a daemon process. Does not return.
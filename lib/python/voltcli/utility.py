@@ -35,7 +35,6 @@ import subprocess
 import glob
 import copy
 import inspect
-import ConfigParser
 import zipfile
 import re
 import pkgutil
@@ -45,6 +44,15 @@ import daemon
 import signal
 import textwrap
 import string
+import io
+import time
+import collections
+import itertools
+import atexit
+import UserDict
+import anydbm
+import whichdb
+import marshal
 
 #===============================================================================
 class Global:
@@ -142,32 +150,27 @@ def display_messages(msgs, f = sys.stdout, tag = None, level = 0):
     else:
         stag = ''
     # Special case to allow a string instead of an iterable.
-    try:
-        # Raises TypeError if not string
-        var = msgs + ' '
+    if isinstance(msgs, basestring):
         msgs = [msgs]
-    except TypeError:
-        pass
-    sindent = level * '  '
+    prefix = stag + level * '  '
+    write = f.write
     # Recursively process message list and sub-lists.
     for msg in msgs:
         if msg is not None:
             # Handle exceptions
-            if issubclass(msg.__class__, Exception):
-                f.write('%s%s%s Exception: %s\n' % (stag, sindent, msg.__class__.__name__, str(msg)))
+            if isinstance(msg, Exception):
+                write('%s%s Exception: %s\n' % (prefix, msg.__class__.__name__, str(msg)))
+            # Handle multi-line strings
+            elif isinstance(msg, basestring):
+                # If it is a string slice and dice it by linefeeds.
+                for msg2 in msg.split('\n'):
+                    write(prefix + msg2 + '\n')
+            # Recursively display an iterable with indentation added.
+            elif hasattr(msg, '__iter__'):
+                display_messages(msg, f = f, tag = tag, level = level + 1)
             else:
-                # Handle multi-line strings
-                if is_string(msg):
-                    # If it is a string slice and dice it by linefeeds.
-                    for msg2 in msg.split('\n'):
-                        f.write('%s%s%s\n' % (stag, sindent, msg2))
-                else:
-                    # Recursively display an iterable with indentation added.
-                    if hasattr(msg, '__iter__'):
-                        display_messages(msg, f = f, tag = tag, level = level + 1)
-                    else:
-                        for msg2 in str(msg).split('\n'):
-                            f.write('%s%s%s\n' % (stag, sindent, msg2))
+                for msg2 in str(msg).split('\n'):
+                    write(prefix + msg2 + '\n')
 
 #===============================================================================
 def info(*msgs):
@@ -230,17 +233,36 @@ def abort(*msgs, **kwargs):
         return_code = 1
     sys.exit(return_code)
 
+# Resolved find_in_path() results keyed by (name, PATH).
+_find_in_path_cache = {}
+
 #===============================================================================
 def find_in_path(name):
 #===============================================================================
     """
-    Find program in the system path.
+    Find program in the system path. Results are cached per name and PATH
+    value. Call find_in_path_reset() to discard the cache.
     """
+    key = (name, os.environ.get('PATH', ''))
+    if key in _find_in_path_cache:
+        return _find_in_path_cache[key]
+    found = None
     # NB: non-portable
-    for dir in os.environ['PATH'].split(':'):
-        if os.path.exists(os.path.join(dir, name)):
-            return os.path.join(dir, name)
-    return None
+    for dir in key[1].split(':'):
+        candidate = os.path.join(dir, name)
+        if os.path.isfile(candidate):
+            found = candidate
+            break
+    _find_in_path_cache[key] = found
+    return found
+
+#===============================================================================
+def find_in_path_reset():
+#===============================================================================
+    """
+    Discard cached find_in_path() results.
+    """
+    _find_in_path_cache.clear()
 
 #===============================================================================
 def find_programs(*names):
@@ -276,7 +298,8 @@ class PythonSourceFinder(object):
 
     def __init__(self):
         self.scan_locs = []
-        self.manifests = {}
+        # Package name -> {directory: [python source paths]}
+        self.manifest_index = {}
 
     def add_path(self, path):
         # Use the absolute path to avoid visiting the same directory more than once.
@@ -291,32 +314,37 @@ class PythonSourceFinder(object):
         self.scan_locs.append(PythonSourceFinder.Scan(package, path))
 
     def search_and_execute(self, **syms):
+        # Each module gets its own (shallow) copy of the symbols because the
+        # functions it defines keep a reference to the module namespace.
         for scan_loc in self.scan_locs:
             verbose_info('Scanning "%s" for modules to run...' % scan_loc.path)
             if scan_loc.package:
                 # Load the manifest as needed so that individual files can be
                 # found in package directories. There doesn't seem to be an
                 # easy way to search for resource files, e.g. by glob pattern.
-                if scan_loc.package not in self.manifests:
+                if scan_loc.package not in self.manifest_index:
                     try:
                         manifest_raw = pkgutil.get_data(scan_loc.package, Global.manifest_path)
-                        self.manifests[scan_loc.package] = manifest_raw.split('\n')
                     except (IOError, OSError), e:
                         abort('Failed to load package %s.' % Global.manifest_path, e)
-                for path in self.manifests[scan_loc.package]:
-                    if os.path.dirname(path) == scan_loc.path and path.endswith('.py'):
-                        debug('Executing package module "%s"...' % path)
-                        try:
-                            code = pkgutil.get_data(scan_loc.package, path)
-                        except (IOError, OSError), e:
-                            abort('Failed to load package resource "%s".' % path, e)
-                        syms_tmp = copy.copy(syms)
-                        exec(code, syms_tmp)
+                    # Index the python sources by directory for quick lookup.
+                    index = {}
+                    for path in manifest_raw.split('\n'):
+                        if path.endswith('.py'):
+                            index.setdefault(os.path.dirname(path), []).append(path)
+                    self.manifest_index[scan_loc.package] = index
+                for path in self.manifest_index[scan_loc.package].get(scan_loc.path, ()):
+                    debug('Executing package module "%s"...' % path)
+                    try:
+                        source = pkgutil.get_data(scan_loc.package, path)
+                    except (IOError, OSError), e:
+                        abort('Failed to load package resource "%s".' % path, e)
+                    # Compile with the resource path for tracebacks.
+                    exec(compile(source, path, 'exec'), syms.copy())
             elif os.path.exists(scan_loc.path):
                 for modpath in glob.glob(os.path.join(scan_loc.path, '*.py')):
                     debug('Executing module "%s"...' % modpath)
-                    syms_tmp = copy.copy(syms)
-                    execfile(modpath, syms_tmp)
+                    execfile(modpath, syms.copy())
 
 #===============================================================================
 def normalize_list(items, width, filler = None):
@@ -354,24 +382,22 @@ def format_table(tuples, caption = None, headings = None, indent = 0, separator
         rows.append(headings)
     # Add the data rows.
     rows.extend(tuples)
-    # Measure the column widths.
-    widths = []
-    for row in rows:
-        icolumn = 0
-        for column in row:
-            width = len(str(column))
-            if len(widths) == icolumn:
-                widths.append(width)
-            else:
-                widths[icolumn] = max(widths[icolumn], width)
-            icolumn += 1
+    # Stringize the cells once and measure the column widths.
+    str_rows = [[str(column) for column in row] for row in rows]
+    widths = [max(map(len, column)) for column in itertools.izip_longest(*str_rows, fillvalue = '')]
+    ncols = len(widths)
     # If we have headings inject a row with underlining based on the calculated widths.
     if headings:
-        rows.insert(1, ['-' * widths[i] for i in range(len(widths))])
+        str_rows.insert(1, ['-' * width for width in widths])
     # Generate the format string and then format the headings and rows.
     fmt = '%s%s' % (sindent, separator.join(['%%-%ds' % width for width in widths]))
-    for row in rows:
-        output.append(fmt % normalize_list(row, len(widths), ''))
+    # Pad short rows with empty cells from a pre-built filler tuple.
+    empty_row = ('',) * ncols
+    for r in str_rows:
+        cells = tuple(r)
+        if len(cells) < ncols:
+            cells += empty_row[len(cells):]
+        output.append(fmt % cells)
     return '\n'.join(output)
 
 #===============================================================================
@@ -391,7 +417,7 @@ def format_tables(tuples_list, caption_list = None, heading_list = None, indent
             heading = None
         else:
             heading = heading_list[i]
-        s = format_table(tuples_list[i], caption = caption, heading = heading, indent = indent)
+        s = format_table(tuples_list[i], caption = caption, headings = heading, indent = indent)
         output.append(s)
     return '\n\n'.join(output)
 
@@ -493,10 +519,35 @@ def run_cmd(cmd, *args):
     else:
         if Global.verbose_enabled:
             verbose_info('Run: %s' % fullcmd)
-        retcode = os.system(fullcmd)
+        # Run directly instead of through a shell. Need to strip out quotes
+        # because the shell won't be doing it for us.
+        # Like os.system(), ignore SIGINT and SIGQUIT while waiting, so that
+        # Ctrl-C only interrupts the child, e.g. a Java program that may still
+        # be writing output while it shuts down. The child gets the default
+        # handlers back, since ignored signals stay ignored across exec.
+        saved_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        saved_sigquit = signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+        try:
+            try:
+                retcode = subprocess.call(unquote_shell_args(cmd, *args),
+                                          preexec_fn = _restore_child_signals)
+            except (OSError, IOError), e:
+                abort('Failed to run:', fullcmd, e)
+        finally:
+            signal.signal(signal.SIGINT, saved_sigint)
+            signal.signal(signal.SIGQUIT, saved_sigquit)
         if retcode != 0:
             abort(return_code=retcode)
 
+#===============================================================================
+def _restore_child_signals():
+#===============================================================================
+    """
+    Restore the default SIGINT and SIGQUIT handlers in a child process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+
 #===============================================================================
 def exec_cmd(cmd, *args):
 #===============================================================================
@@ -522,8 +573,20 @@ def pipe_cmd(*args):
     """
     try:
         proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        for line in iter(proc.stdout.readline, ''):
-            yield line.rstrip()
+        # Read large chunks from the raw pipe and split the lines locally.
+        # The partial line at the end of each chunk is carried over.
+        fd = proc.stdout.fileno()
+        buf = ''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            lines = (buf + chunk).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                yield line.rstrip()
+        if buf:
+            yield buf.rstrip()
         proc.stdout.close()
     except Exception, e:
         warning('Exception running command: %s' % ' '.join(args), e)
@@ -653,13 +716,9 @@ class Daemonizer(daemon.Daemon):
 def is_string(item):
 #===============================================================================
     """
-    Return True if the item behaves like a string.
+    Return True if the item is a string.
     """
-    try:
-        test_string = item + ''
-        return True
-    except TypeError:
-        return False
+    return isinstance(item, basestring)
 
 #===============================================================================
 def is_sequence(item):
@@ -667,30 +726,26 @@ def is_sequence(item):
     """
     Return True if the item behaves like an iterable sequence.
     """
-    if is_string(item):
-        return False
-    try:
-        for var in item:
-            break
-        return True
-    except TypeError:
-        return False
+    return not isinstance(item, basestring) and hasattr(item, '__iter__')
 
 #===============================================================================
 def _flatten(item):
 #===============================================================================
     """
-    Internal function to recursively iterate a potentially nested sequence.
-    None items are filtered out.
+    Internal function to iterate a potentially nested sequence. Uses a stack
+    of iterators instead of recursion. None items are filtered out.
     """
-    if item is not None:
-        if is_sequence(item):
-            for subitem in item:
-                for subsubitem in _flatten(subitem):
-                    if subsubitem is not None:
-                        yield subsubitem
+    stack = [iter((item,))]
+    while stack:
+        for subitem in stack[-1]:
+            if subitem is not None:
+                if not isinstance(subitem, basestring) and hasattr(subitem, '__iter__'):
+                    # Descend into the sub-sequence and resume here afterwards.
+                    stack.append(iter(subitem))
+                    break
+                yield subitem
         else:
-            yield item
+            stack.pop()
 
 #===============================================================================
 def flatten(*items):
@@ -734,12 +789,20 @@ class Zipper(object):
     the resulting file executable in order to support making a self-executable
     compressed Python program.
     """
+    # Read size for input file data beyond the size reported by stat().
+    buffer_size = 128 * 1024
+    # Output file buffer size, so that compressed data is written in large chunks.
+    output_buffer_size = 1 << 20
+    # Files with these extensions are already compressed and are stored as is.
+    precompressed_extensions = frozenset(['.jar', '.war', '.zip', '.gz', '.bz2', '.xz', '.png', '.jpg'])
+
     def __init__(self, excludes = []):
         self.output_file = None
         self.output_zip  = None
         self.output_path = None
-        self.manifest    = []
+        self.manifest_buf = io.BytesIO()
         self.re_excludes = [re.compile(exclude) for exclude in excludes]
+        self._exclude_searches = [r.search for r in self.re_excludes]
 
     def open(self, output_path, preamble = None, force = False):
         if os.path.exists(output_path) and not force:
@@ -748,7 +811,7 @@ class Zipper(object):
         self.output_path = output_path
         if not Global.dryrun_enabled:
             try:
-                self.output_file = open(output_path, 'w');
+                self.output_file = open(output_path, 'wb', Zipper.output_buffer_size)
                 if preamble:
                     self.output_file.write(preamble)
                 self.output_zip = zipfile.ZipFile(self.output_file, 'w', zipfile.ZIP_DEFLATED)
@@ -759,7 +822,7 @@ class Zipper(object):
         if self.output_zip:
             # Write the manifest.
             try:
-                self.output_zip.writestr(Global.manifest_path, '\n'.join(self.manifest))
+                self.output_zip.writestr(Global.manifest_path, self.manifest_buf.getvalue().rstrip('\n'))
             except (IOError, OSError), e:
                 self._abort('Failed to write %s.' % Global.manifest_path, e)
             self.output_zip.close()
@@ -772,17 +835,20 @@ class Zipper(object):
                     self._abort('Failed to add executable permission.', e)
 
     def add_file(self, path_in, path_out):
-        for re_exclude in self.re_excludes:
+        # The real path is only needed for verbose messages.
+        if Global.verbose_enabled:
             path_in_full = os.path.realpath(path_in)
-            if re_exclude.search(path_in):
-                self._verbose_info('skip "%s"' % path_in_full)
-                break
+        else:
+            path_in_full = path_in
+        if any(search(path_in) for search in self._exclude_searches):
+            self._verbose_info('skip "%s"' % path_in_full)
         else:
             self._verbose_info('add "%s" as "%s"' % (path_in_full, path_out))
             try:
                 if self.output_zip:
-                    self.output_zip.write(path_in, path_out)
-                    self.manifest.append(path_out)
+                    zinfo = self._zip_info(path_in, path_out)
+                    self.output_zip.writestr(zinfo, self._read_file(path_in, zinfo.file_size))
+                    self.manifest_buf.write(path_out + '\n')
             except (IOError, OSError), e:
                 self._abort('Failed to write file "%s".' % path_out, e)
 
@@ -791,7 +857,7 @@ class Zipper(object):
         if self.output_zip:
             try:
                 self.output_zip.writestr(path_out, s)
-                self.manifest.append(path_out)
+                self.manifest_buf.write(path_out + '\n')
             except (IOError, OSError), e:
                 self._abort('Failed to write string to file "%s".' % path_out, e)
 
@@ -802,21 +868,81 @@ class Zipper(object):
         savedir = os.getcwd()
         # Get nice relative paths by temporarily switching directories.
         os.chdir(path_in)
+        if dst:
+            prefix_out = dst + '/'
+        else:
+            prefix_out = ''
         try:
-            for basedir, subdirs, filenames in os.walk('.'):
-                for filename in filenames:
-                    file_path_in = os.path.join(basedir[2:], filename)
-                    file_path_out = os.path.join(dst, basedir[2:], filename)
-                    self.add_file(file_path_in, file_path_out)
+            # Depth-first traversal in the same order as os.walk(), only
+            # checking for directories since files are stat'ed when added.
+            # Symbolic links to directories are not followed.
+            stack = ['']
+            while stack:
+                basedir = stack.pop()
+                try:
+                    names = os.listdir(basedir or '.')
+                except (IOError, OSError):
+                    # Unreadable directories are skipped, like os.walk() does.
+                    continue
+                if basedir:
+                    prefix = basedir + '/'
+                else:
+                    prefix = ''
+                subdirs = []
+                for name in names:
+                    rel_path = prefix + name
+                    if os.path.isdir(rel_path):
+                        if not os.path.islink(rel_path):
+                            subdirs.append(rel_path)
+                    else:
+                        self.add_file(rel_path, prefix_out + rel_path)
+                stack.extend(reversed(subdirs))
         finally:
             os.chdir(savedir)
 
+    def _zip_info(self, path_in, path_out):
+        # Preserve the time stamp and permissions like ZipFile.write() does.
+        st = os.stat(path_in)
+        zinfo = zipfile.ZipInfo(path_out, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.file_size = st.st_size
+        if os.path.splitext(path_in)[1].lower() in Zipper.precompressed_extensions:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = self.output_zip.compression
+        return zinfo
+
+    def _read_file(self, path_in, size):
+        # Read the whole file with one unbuffered read() of the size from
+        # stat(), which reads straight into the returned string. (A bytearray
+        # would be copied to a string anyway, because crc32() in writestr()
+        # doesn't accept one.) Keep reading in case the file grew since then.
+        # Unlike ZipFile.write(), the file isn't streamed, but the files
+        # zipped by voltcli are small.
+        chunks = []
+        nbytes = size or Zipper.buffer_size
+        f = io.open(path_in, 'rb', buffering = 0)
+        try:
+            while True:
+                chunk = f.read(nbytes)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                nbytes = Zipper.buffer_size
+        finally:
+            f.close()
+        # Joining a single chunk returns it without copying.
+        return ''.join(chunks)
+
     def _verbose_info(self, msg):
         verbose_info('%s: %s' % (self.output_path, msg))
 
     def _abort(self, *msgs):
         abort('Fatal error writing zip file "%s".' % self.output_path, msgs)
 
+# Characters deleted by str.translate() to extract -X option symbols.
+_java_option_non_alpha = ''.join([chr(i) for i in range(256) if chr(i) not in string.ascii_letters])
+
 #===============================================================================
 def merge_java_options(*opts):
 #===============================================================================
@@ -831,7 +957,7 @@ def merge_java_options(*opts):
             # This is somewhat simplistic logic that might have unlikely failure scenarios.
             if opt.startswith('-X'):
                 # The symbol is the initial string of contiguous alphabetic characters.
-                sym = ''.join([c for c in opt[2:] if c.isalpha()])
+                sym = str(opt[2:]).translate(None, _java_option_non_alpha)
                 if sym not in xargs:
                     xargs.add(sym)
                     ret_opts.append(opt)
@@ -872,11 +998,16 @@ def choose(prompt, *choices):
             abort('Non-unique choices %s passed to choose().' % str(choices))
         letters.add(choice[0])
         choice_list.append('[%s]%s' % (choice[0], choice[1:]))
+    valid = frozenset(choices) | letters
+    full_prompt = '%s (%s) ' % (prompt, '/'.join(choice_list))
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    readline = sys.stdin.readline
     while True:
-        sys.stdout.write('%s (%s) ' % (prompt, '/'.join(choice_list)))
-        sys.stdout.flush()
-        response = sys.stdin.readline().strip()
-        if response in letters or response in choices:
+        write(full_prompt)
+        flush()
+        response = readline().strip()
+        if response in valid:
             return response[0]
 
 #===============================================================================
@@ -885,12 +1016,8 @@ def dict_to_sorted_pairs(d):
     """
     Convert a dictionary to a list of key/value pairs sorted by key.
     """
-    keys = d.keys()
-    keys.sort()
-    results = []
-    for key in keys:
-        results.append((key, d[key]))
-    return results
+    # Keys are unique, so sorting the pairs sorts by key.
+    return sorted(d.iteritems())
 
 #===============================================================================
 def pluralize(s, count):
@@ -975,6 +1102,9 @@ def kwargs_set_defaults(kwargs, **defaults):
         if name not in kwargs:
             kwargs[name] = defaults[name]
 
+# Host name and port returned by parse_hosts().
+Host = collections.namedtuple('Host', 'host port')
+
 #===============================================================================
 def parse_hosts(host_string, min_hosts = None, max_hosts = None, default_port = None):
 #===============================================================================
@@ -982,28 +1112,21 @@ def parse_hosts(host_string, min_hosts = None, max_hosts = None, default_port =
     Split host string on commas, extract optional port for each and return list
     of host objects. Check against minimum/maximum quantities if specified.
     """
-    class Host(object):
-        def __init__(self, host, port):
-            self.host = host
-            self.port = port
     hosts = []
+    append = hosts.append
+    # Add the default port if specified. Validated by caller to be an integer.
+    default = default_port or None
     for host_port in host_string.split(','):
-        split_host = host_port.split(':')
-        host = split_host[0]
-        if len(split_host) > 2:
+        if host_port.count(':') > 1:
             abort('Bad HOST:PORT format "%s" - too many colons.' % host_port)
+        split_host = host_port.split(':', 1)
         if len(split_host) == 1:
-            # Add the default port if specified. Validated by caller to be an integer.
-            if default_port:
-                port = default_port
-            else:
-                port = None
+            append(Host(split_host[0], default))
         else:
             try:
-                port = int(split_host[1])
+                append(Host(split_host[0], int(split_host[1])))
             except ValueError, e:
                 abort('Bad port value "%s" for host: %s' % (split_host[1], host_port))
-        hosts.append(Host(host, port))
     if min_hosts is not None and len(hosts) < min_hosts:
         abort('Too few hosts in host string "%s". The minimum is %d.'
                     % (host_string, min_hosts))
@@ -1066,7 +1189,28 @@ class File(object):
             if self.f is None:
                 f.close()
     def read_hex(self):
-        return binascii.hexlify(self.read())
+        if self.mode != 'r':
+            self._abort('File is not open for reading in call to read_hex().')
+        # Hexlify 64 KiB chunks to avoid holding both the raw and hex data.
+        if self.f is None:
+            f = self._open()
+        else:
+            f = self.f
+        output = []
+        try:
+            try:
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    output.append(binascii.hexlify(chunk))
+            except (IOError, OSError), e:
+                self._abort('Read error.', e)
+        finally:
+            # Close locally-opened file.
+            if self.f is None:
+                f.close()
+        return ''.join(output)
     def write(self, s):
         if self.mode != 'w':
             self._abort('File is not open for writing in call to write().')
@@ -1141,42 +1285,435 @@ class FileGenerator(object):
             output_stream.close()
 
 
+# Precompiled INI section header and option line patterns.
+_ini_section_re = re.compile(r'^\[([^\]]+)\]')
+_ini_option_re  = re.compile(r'^([^:=\s][^:=]*?)\s*[:=]\s*(.*?)\s*$')
+
 #===============================================================================
 class INIConfigManager(object):
 #===============================================================================
     """
     Loads/saves INI format configuration to and from a dictionary.
-    """
+    Parsed files are cached until their modification time or size changes,
+    both in memory and, for later invocations, in a marshal "shadow" file
+    named <path>.cache next to the INI file, e.g. volt.cfg.cache. The shadow
+    file is written by the first load() of a file and by save(), with the
+    same permissions as the INI file.
+
+    Uses a simple precompiled regex line parser, rather than ConfigParser,
+    for the "[section]" and "name = value" lines written by save(). Option
+    names are lower-cased like ConfigParser does it, and indented lines
+    continue the previous value, e.g. for multi-line values written by save().
+    Not supported: value interpolation, DEFAULT section inheritance and inline
+    ";" comments (they are kept as part of the value).
+
+    save() writes a temporary file and renames it over the original, so the
+    directory, not just the file, must be writable. A symbolic link is
+    followed and its target is replaced.
+    """
+
+    # Parsed dictionaries keyed by (path, mtime, size) and the least recently
+    # used first key order. (OrderedDict would require Python 2.7.)
+    cache = {}
+    cache_order = []
+    cache_max = 128
 
     def load(self, path):
-        parser = ConfigParser.SafeConfigParser()
-        parser.read(path)
-        d = dict()
-        for section in parser.sections():
-            for name, value in parser.items(section):
-                d['%s.%s' % (section, name)] = value
+        try:
+            st = os.stat(path)
+        except (IOError, OSError):
+            # A missing file is an empty configuration.
+            return {}
+        key = (path, st.st_mtime, st.st_size)
+        d = INIConfigManager.cache.get(key)
+        if d is None:
+            d = self._load_shadow(path, st)
+            if d is None:
+                d = self._parse(path, self._read(path, st.st_size))
+                self._save_shadow(path, st, d)
+            self._cache_put(key, d)
+        else:
+            INIConfigManager.cache_order.remove(key)
+            INIConfigManager.cache_order.append(key)
+        # Copy, because callers are free to modify the returned dictionary.
+        return dict(d)
+
+    def _read(self, path, size):
+        # Slurp the file with a single read() using the size from stat().
+        # Keep reading only if the file grew in the meantime.
+        chunks = []
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                while True:
+                    chunk = os.read(fd, size + 1)
+                    chunks.append(chunk)
+                    if len(chunk) <= size:
+                        break
+            finally:
+                os.close(fd)
+        except (IOError, OSError), e:
+            abort('Failed to read configuration file "%s".' % path, e)
+        return ''.join(chunks)
+
+    def _load_shadow(self, path, st):
+        # The shadow file holds the (mtime, size) of the INI file it was
+        # generated from, so that a stale or foreign one is ignored. One
+        # with other permissions is ignored too, so that it gets rewritten
+        # after a chmod of the INI file, which doesn't change the mtime.
+        try:
+            f = open('%s.cache' % path, 'rb')
+            try:
+                if stat.S_IMODE(os.fstat(f.fileno()).st_mode) != stat.S_IMODE(st.st_mode):
+                    return None
+                mtime, size, d = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if mtime != st.st_mtime or size != st.st_size or not isinstance(d, dict):
+            return None
+        return d
+
+    def _save_shadow(self, path, st, d):
+        # The shadow file is only an optimization, e.g. the directory may
+        # not be writable, so failures are ignored. Write it under a
+        # temporary name so that a concurrent load() never sees it partially
+        # written. It holds the same data as the INI file, so it gets the
+        # same permissions.
+        shadow_path = '%s.cache' % path
+        tmp_path = '%s.%d.tmp' % (shadow_path, os.getpid())
+        try:
+            f = self._create_tmp(tmp_path, stat.S_IMODE(st.st_mode))
+            try:
+                marshal.dump((st.st_mtime, st.st_size, d), f)
+            finally:
+                f.close()
+            os.rename(tmp_path, shadow_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _create_tmp(self, tmp_path, mode):
+        # Create the temporary file with the permissions of the file it
+        # replaces, if any, so that the data is never more widely readable.
+        # A file left behind by an earlier process with the same ID is
+        # removed, because O_EXCL refuses to open it.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        if mode is None:
+            return os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), 'wb')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        try:
+            # The umask may have removed some of the permissions.
+            os.fchmod(fd, mode)
+            return os.fdopen(fd, 'wb')
+        except:
+            os.close(fd)
+            raise
+
+    def _cache_put(self, key, d):
+        if len(INIConfigManager.cache_order) >= INIConfigManager.cache_max:
+            del INIConfigManager.cache[INIConfigManager.cache_order.pop(0)]
+        INIConfigManager.cache[key] = d
+        INIConfigManager.cache_order.append(key)
+
+    def _cache_discard(self, path):
+        for key in [key for key in INIConfigManager.cache_order if key[0] == path]:
+            del INIConfigManager.cache[key]
+            INIConfigManager.cache_order.remove(key)
+
+    def _parse(self, path, text):
+        d = {}
+        section = None
+        key = None
+        for iline, line in enumerate(text.split('\n')):
+            # Skip blank lines and comments.
+            if not line.strip() or line[0] in '#;':
+                continue
+            # Append a continuation line to the previous value.
+            if line[0].isspace() and key is not None:
+                d[key] = '%s\n%s' % (d[key], line.strip())
+                continue
+            m = _ini_section_re.match(line)
+            if m:
+                section = m.group(1)
+                key = None
+                continue
+            m = _ini_option_re.match(line)
+            if not m:
+                abort('Bad line %d in configuration file "%s":' % (iline + 1, path), line)
+            if section is None:
+                abort('Option outside of a section in configuration file "%s":' % path, line)
+            value = m.group(2)
+            if value == '""':
+                value = ''
+            # Intern the keys, since the same keys are looked up repeatedly
+            # and shared by the permanent and local configurations.
+            key = intern('%s.%s' % (section, m.group(1).lower()))
+            d[key] = value
         return d
 
     def save(self, path, d):
-        parser = ConfigParser.SafeConfigParser()
-        keys = d.keys()
-        keys.sort()
+        # Generate the same output as ConfigParser.write().
+        output = []
         cur_section = None
-        for key in keys:
+        for key in sorted(d):
             if key.find('.') == -1:
                 abort('Key "%s" must have a section, e.g. "volt.%s"' % (key, key))
             else:
                 section, name = key.split('.', 1)
             if cur_section is None or section != cur_section:
-                parser.add_section(section)
+                if cur_section is not None:
+                    output.append('\n')
+                output.append('[%s]\n' % section)
                 cur_section = section
-            parser.set(cur_section, name, d[key])
-        f = File(path, 'w')
-        f.open()
+            value = str(d[key]).replace('\n', '\n\t')
+            output.append('%s = %s\n' % (name.lower(), value))
+        if output:
+            output.append('\n')
+        # Unicode keys or values make the text unicode. Convert it to the bytes
+        # that file.write() would write, so that _parse() gets the same byte
+        # string keys, which can be interned, as a load() of the file does.
+        text = str(''.join(output))
+        # Don't trust the time stamp of a file rewritten within its resolution.
+        self._cache_discard(path)
+        try:
+            os.remove('%s.cache' % path)
+        except OSError:
+            pass
+        # Write a temporary file and rename it over the original. The rename
+        # is atomic, so readers see either the old or the new file and never
+        # a partially written one. The temporary file name includes the
+        # process ID, so that concurrent saves don't write the same file.
+        # It is a deliberate trade-off not to fsync, to keep saves cheap, so
+        # a system crash can still lose the latest save.
+        # Replace the target of a symbolic link rather than the link.
+        real_path = os.path.realpath(path)
         try:
-            parser.write(f)
+            mode = stat.S_IMODE(os.stat(real_path).st_mode)
+        except OSError:
+            mode = None
+        tmp_path = '%s.%d.tmp' % (real_path, os.getpid())
+        replaced = False
+        try:
+            try:
+                f = self._create_tmp(tmp_path, mode)
+                try:
+                    f.write(text)
+                finally:
+                    f.close()
+                os.rename(tmp_path, real_path)
+            except (IOError, OSError), e:
+                abort('Failed to write configuration file "%s".' % path, e)
+            replaced = True
         finally:
-            f.close()
+            # Don't leave the temporary file behind after a failure.
+            if not replaced:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        # The next load() of the file, e.g. by another PersistentConfig or a
+        # later invocation, can use the cached dictionary without reading the
+        # file again. Parse the written text, so that the cache holds exactly
+        # what load() would get from the file.
+        saved = self._parse(path, text)
+        st = os.stat(path)
+        self._cache_put((path, st.st_mtime, st.st_size), saved)
+        self._save_shadow(path, st, saved)
+
+#===============================================================================
+class DBMConfigManager(object):
+#===============================================================================
+    """
+    Loads/saves configuration in a dbm database file. The loaded dictionary
+    is backed by the open database, so setting a key is an incremental write
+    and save() only needs to sync it, rather than rewriting a whole file.
+    Keys and values are stored as strings. An existing database is opened
+    read-only, and a missing one is only created by the first change, so that
+    plain lookups don't create database files.
+    """
+
+    class Database(UserDict.DictMixin):
+        """
+        Dictionary interface to a dbm database, which is None until the first
+        change if the database didn't exist. Implements get() and iteration,
+        which some dbm modules lack.
+        """
+        def __init__(self, path, db):
+            self.path     = path
+            self.db       = db
+            self.writable = False
+        def __getitem__(self, key):
+            if self.db is None:
+                raise KeyError(key)
+            return self.db[key]
+        def __setitem__(self, key, value):
+            self._open_for_write()
+            self.db[key] = str(value)
+        def __delitem__(self, key):
+            if self.db is None:
+                raise KeyError(key)
+            self._open_for_write()
+            del self.db[key]
+        def __contains__(self, key):
+            return self.db is not None and self.db.has_key(key)
+        def __iter__(self):
+            return iter(self.keys())
+        def __len__(self):
+            if self.db is None:
+                return 0
+            return len(self.db)
+        def keys(self):
+            if self.db is None:
+                return []
+            return self.db.keys()
+        def get(self, key, default = None):
+            if self.db is not None and self.db.has_key(key):
+                return self.db[key]
+            return default
+        def sync(self):
+            # Not all dbm modules have sync(), e.g. dbm, which writes through.
+            if self.writable and hasattr(self.db, 'sync'):
+                self.db.sync()
+        def _open_for_write(self):
+            # Reopen a read-only database, or create a missing one.
+            if not self.writable:
+                if self.db is not None:
+                    self.db.close()
+                    self.db = None
+                try:
+                    self.db = anydbm.open(self.path, 'c')
+                except anydbm.error, e:
+                    abort('Failed to open configuration database "%s".' % self.path, e)
+                self.writable = True
+
+    def load(self, path):
+        # whichdb() returns None if there is no readable database.
+        if whichdb.whichdb(path) is None:
+            return DBMConfigManager.Database(path, None)
+        try:
+            return DBMConfigManager.Database(path, anydbm.open(path, 'r'))
+        except anydbm.error, e:
+            abort('Failed to open configuration database "%s".' % path, e)
+
+    def save(self, path, d):
+        if isinstance(d, DBMConfigManager.Database) and d.path == path:
+            d.sync()
+        else:
+            # Replace the contents of another database with the dictionary.
+            db = self.load(path)
+            for key in db.keys():
+                if key not in d:
+                    del db[key]
+            for key in d:
+                db[key] = d[key]
+            db.sync()
+
+#===============================================================================
+class KeyPrefixIndex(object):
+#===============================================================================
+    """
+    Tree of dotted keys, e.g. "volt.catalog", indexed by "." separated
+    segment. Finds the keys that start with a prefix without scanning all
+    keys.
+    """
+
+    def __init__(self, keys = []):
+        # Nested segment dictionaries. A None entry holds a complete key.
+        self.root = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        node = self.root
+        for segment in key.split('.'):
+            node = node.setdefault(segment, {})
+        node[None] = key
+
+    def find(self, prefix):
+        """
+        Return a list of the keys that start with prefix.
+        """
+        segments = prefix.split('.')
+        node = self.root
+        for segment in segments[:-1]:
+            node = node.get(segment)
+            if node is None:
+                return []
+        # The last segment can be partial. Compare slices, which is cheaper
+        # than calling startswith() for short segments.
+        last = segments[-1]
+        if last:
+            nlast = len(last)
+            stack = [child for segment, child in node.iteritems()
+                            if segment is not None and segment[:nlast] == last]
+        else:
+            stack = [child for segment, child in node.iteritems() if segment is not None]
+        keys = []
+        while stack:
+            node = stack.pop()
+            for segment, child in node.iteritems():
+                if segment is None:
+                    keys.append(child)
+                else:
+                    stack.append(child)
+        return keys
+
+# Sentinel for dictionary lookups where None is a valid value.
+_missing = object()
+
+#===============================================================================
+class OverrideView(UserDict.DictMixin):
+#===============================================================================
+    """
+    Read-only dictionary view of one or more dictionaries. A key found in an
+    earlier dictionary overrides the same key in later ones, like Python 3's
+    collections.ChainMap. Nothing is copied, so the view reflects changes to
+    the underlying dictionaries. Use dict(view) to get a modifiable copy.
+    """
+
+    def __init__(self, *maps):
+        self.maps = maps
+
+    def __getitem__(self, key):
+        for d in self.maps:
+            value = d.get(key, _missing)
+            if value is not _missing:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default = None):
+        for d in self.maps:
+            value = d.get(key, _missing)
+            if value is not _missing:
+                return value
+        return default
+
+    def __contains__(self, key):
+        for d in self.maps:
+            if key in d:
+                return True
+        return False
+
+    def __iter__(self):
+        seen = set()
+        for d in self.maps:
+            for key in d:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+    def keys(self):
+        return list(self)
 
 #===============================================================================
 class PersistentConfig(object):
@@ -1184,6 +1721,7 @@ class PersistentConfig(object):
     """
     Persistent access to configuration data. Manages two configuration
     files, one for permanent configuration and the other for local state.
+    Changes are saved by flush(), which is also called automatically at exit.
     """
 
     def __init__(self, format, path, local_path):
@@ -1195,79 +1733,149 @@ class PersistentConfig(object):
         self.local_path = local_path
         if format.lower() == 'ini':
             self.config_manager = INIConfigManager()
+        elif format.lower() == 'dbm':
+            self.config_manager = DBMConfigManager()
         else:
             abort('Unsupported configuration format "%s".' % format)
-        self.permanent = self.config_manager.load(self.path)
-        if self.local_path:
-            self.local = self.config_manager.load(self.local_path)
-        else:
-            self.local = {}
+        # The configuration files are loaded on first access.
+        self._permanent = None
+        self._local = None
+        self._permanent_dirty = False
+        self._local_dirty = False
+        # Key index for prefix queries, built by the first one.
+        self._index = None
+        atexit.register(self.flush)
+
+    def _load_permanent(self):
+        if self._permanent is None:
+            self._permanent = self.config_manager.load(self.path)
+        return self._permanent
+
+    def _load_local(self):
+        if self._local is None:
+            if self.local_path:
+                self._local = self.config_manager.load(self.local_path)
+            else:
+                self._local = {}
+        return self._local
+
+    @property
+    def permanent(self):
+        """
+        Read-only view of the permanent configuration, loaded as needed.
+        Use set_permanent() for changes, so that they are saved and indexed.
+        """
+        return OverrideView(self._load_permanent())
+
+    @property
+    def local(self):
+        """
+        Read-only view of the local configuration, loaded as needed.
+        Use set_local() for changes, so that they are saved and indexed.
+        """
+        return OverrideView(self._load_local())
 
     def save_permanent(self):
         """
         Save the permanent configuration.
         """
-        self.config_manager.save(self.path, self.permanent)
+        # Nothing can have changed if it was never loaded.
+        if self._permanent is not None:
+            self.config_manager.save(self.path, self._permanent)
+        self._permanent_dirty = False
 
     def save_local(self):
         """
         Save the local configuration (overrides and additions to permanent).
         """
-        if self.local:
-            self.config_manager.save(self.local_path, self.local)
+        if self.local_path:
+            # Nothing can have changed if it was never loaded.
+            if self._local is not None:
+                self.config_manager.save(self.local_path, self._local)
+            self._local_dirty = False
         else:
-            error('No local configuration was specified. (%s)' % tag,
+            error('No local configuration was specified.',
                   'For reference, the permanent configuration is "%s".' % self.path)
 
+    def flush(self):
+        """
+        Save the permanent and/or local configuration if either has changed.
+        """
+        if self._permanent_dirty:
+            self.save_permanent()
+        if self._local_dirty:
+            self.save_local()
+
     def get(self, key):
         """
         Get a value for a key from the merged configuration.
         """
-        if key in self.local:
-            return self.local[key]
-        return self.permanent.get(key, None)
+        # Same lookup as view().get(), but avoids loading the permanent
+        # configuration for local values.
+        value = self._load_local().get(key, _missing)
+        if value is _missing:
+            return self._load_permanent().get(key)
+        return value
 
     def set_permanent(self, key, value):
         """
         Set a key/value pair in the permanent configuration.
+        The change is saved by the next flush().
         """
-        self.permanent[key] = value
-        self.save_permanent()
+        # Setting an unchanged value doesn't require a save.
+        permanent = self._load_permanent()
+        if permanent.get(key, _missing) == value:
+            return
+        permanent[key] = value
+        self._permanent_dirty = True
+        if self._index is not None:
+            self._index.add(key)
 
     def set_local(self, key, value):
         """
         Set a key/value pair in the local configuration.
+        The change is saved by the next flush().
         """
-        self.local[key] = value
-        if self.local:
-            self.save_local()
+        # Setting an unchanged value doesn't require a save.
+        local = self._load_local()
+        if local.get(key, _missing) == value:
+            return
+        local[key] = value
+        self._local_dirty = True
+        if self._index is not None:
+            self._index.add(key)
+
+    def view(self):
+        """
+        Return a read-only merged view of the local and permanent
+        configurations, with local values taking precedence. The view is not
+        a copy. Use dict(view) for a dictionary that can be modified.
+        """
+        return OverrideView(self._load_local(), self._load_permanent())
 
-    def query(self, filter = None):
+    def query(self, prefix = None):
         """
         Query for keys and values as a merged dictionary.
-        The optional filter is matched against the start of each key.
+        The optional prefix is matched against the start of each key.
+        Without a prefix the result is the read-only view() of the
+        configuration.
         """
-        if filter:
-            results = {}
-            for key in self.local:
-                if key.startswith(filter):
-                    results[key] = self.local[key]
-            for key in self.permanent:
-                if key not in results and key.startswith(filter):
-                    results[key] = self.permanent[key]
-        else:
-            results = self.local
-            for key in self.permanent:
-                if key not in results:
-                    results[key] = self.permanent[key]
-        return results
-
-    def query_pairs(self, filter = None):
+        view = self.view()
+        if not prefix:
+            return view
+        if self._index is None:
+            self._index = KeyPrefixIndex(self._load_permanent())
+            for key in self._load_local():
+                self._index.add(key)
+        # Only visit the matching keys found by the index.
+        return dict([(key, view[key]) for key in self._index.find(prefix)])
+
+    def query_pairs(self, prefix = None):
         """
         Query for keys and values as a sorted list of (key, value) pairs.
-        The optional filter is matched against the start of each key.
+        The optional prefix is matched against the start of each key.
         """
-        return dict_to_sorted_pairs(self.query(filter = filter))
+        return dict_to_sorted_pairs(self.query(prefix = prefix))
 
 #===============================================================================
 class VoltTupleWrapper(object):
@@ -254,7 +254,7 @@ def run_config_get(runner):
         # Specific keys requested.
         for arg in runner.opts.arg:
             n = 0
-            for (key, value) in runner.config.query_pairs(filter=config_key(arg)):
+            for (key, value) in runner.config.query_pairs(prefix=config_key(arg)):
                 sys.stdout.write('%s=%s\n' % (key, value))
                 n += 1
             if n == 0: